@@ -9,6 +9,8 @@
 # which is included in the root directory of this package.
 #
 import concurrent.futures
+import functools
+import logging
 import numpy as np
 import mrcfile
 import random
@@ -22,10 +24,30 @@ from math import sqrt, ceil
 __all__ = ["average_particles", "average_all_particles"]
 
 
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
 # Set the random seed
 random.seed(0)
 
 
+# Scratch buffers reused across particles within a worker process
+_SCRATCH: dict = {}
+
+
+def _get_scratch(shape):
+    """
+    Get a scratch buffer, allocated once per shape and reused across calls
+
+    """
+    buffer = _SCRATCH.get(shape)
+    if buffer is None:
+        buffer = np.empty(shape, dtype=np.float32)
+        _SCRATCH[shape] = buffer
+    return buffer
+
+
 def _rotate_array(data, rotation, offset):
     # Create the pixel indices
     az = np.arange(data.shape[0])
@@ -58,13 +80,31 @@ def _rotate_array(data, rotation, offset):
     y = y.reshape(data.shape)
     z = z.reshape(data.shape)
 
-    # sample
-    result = scipy.ndimage.map_coordinates(data, [x, y, z], order=1)
+    # sample into a reused scratch buffer rather than allocating a volume
+    # per particle. This is safe because the result is serialized before
+    # the worker picks up its next particle
+    result = _get_scratch(data.shape)
+    scipy.ndimage.map_coordinates(data, [x, y, z], order=1, output=result)
     return result
 
 
+@functools.lru_cache(maxsize=1)
+def _open_tomogram(filename):
+    """
+    Open a memory mapped tomogram, cached for the lifetime of the process
+
+    """
+    return mrcfile.mmap(filename)
+
+
 def _process_sub_tomo(args):
-    sub_tomo, position, orientation, half_index = args
+    rec_filename, x0, x1, position, orientation, half_index = args
+
+    # Read the sub tomogram from the memory mapped reconstruction. Only the
+    # filename and slice bounds cross the process boundary so each worker
+    # maps the file once and the OS page cache serves all of them
+    tomogram = _open_tomogram(rec_filename).data
+    sub_tomo = tomogram[x0[1] : x1[1], x0[2] : x1[2], x0[0] : x1[0]]
 
     # Set the data to transform
     data = sub_tomo
@@ -76,7 +116,7 @@ def _process_sub_tomo(args):
     rotation[1] = -rotation[1]
 
     # Rotate the data
-    print("Rotating volume")
+    logger.debug("Rotating volume")
     data = _rotate_array(data, rotation, offset)
     return half_index, data
 
@@ -90,8 +130,9 @@ def _iterate_particles(
     half_length,
     half_shape,
     voxel_size,
-    tomogram,
+    rec_filename,
 ):
+    tomogram = _open_tomogram(rec_filename).data
     for j in range(len(indices)):
         for i in indices[j]:
             position = positions[i]
@@ -101,7 +142,7 @@ def _iterate_particles(
             # start_position = np.array([0, scan["start_pos"], 0])
             p = position - (centre - size / 2.0)  # - start_position
             p[2] = size[2] - p[2]
-            print(
+            logger.debug(
                 "Particle %d: position = %s, orientation = %s"
                 % (
                     i,
@@ -115,24 +156,31 @@ def _iterate_particles(
             x1 = np.floor(p / voxel_size).astype("int32") + half_length
             offset = p - np.floor(p).astype("int32")
 
-            # Get the sub tomogram
-            print("Getting sub tomogram")
+            # Check the sub tomogram shape without reading any data (slicing
+            # the memory map is lazy) and leave the read to the worker
             sub_tomo = tomogram[x0[1] : x1[1], x0[2] : x1[2], x0[0] : x1[0]]
             if sub_tomo.shape == half_shape[-3:]:
-                yield (sub_tomo, offset, orientation, j)
+                yield (rec_filename, x0, x1, offset, orientation, j)
 
 
 def lazy_map(executor, func, iterable):
     """
     A lazy map function for concurrent processes
 
+    The number of in-flight futures is limited to twice the number of
+    workers so that the workers stay busy without the pending results
+    ballooning in memory
+
     """
-    max_workers = executor._max_workers
+    max_pending = 2 * executor._max_workers
 
     futures = []
     for it in iterable:
         futures.append(executor.submit(func, it))
-        while len(futures) >= max_workers:
+        while len(futures) >= max_pending:
+            concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
             temp = []
             for f in futures:
                 if f.done():
@@ -263,7 +311,7 @@ def _average_particles_Config(
             num_particles = len(positions)
         else:
             num_particles = min(num_particles, len(positions))
-        print(
+        logger.info(
             "Averaging %d %s particles with box size %d" % (num_particles, name, length)
         )
 
@@ -272,9 +320,11 @@ def _average_particles_Config(
         num = np.zeros(shape=(2,), dtype="float32")
 
         # Sort the positions and orientations by y
-        positions, orientations = zip(
-            *sorted(zip(positions, orientations), key=lambda x: x[0][1])
-        )
+        positions = np.asarray(positions)
+        orientations = np.asarray(orientations)
+        order = np.argsort(positions[:, 1], kind="stable")
+        positions = positions[order]
+        orientations = orientations[order]
 
         # Get the random indices
         indices = list(
@@ -296,7 +346,7 @@ def _average_particles_Config(
                     half_length,
                     half.shape,
                     voxel_size,
-                    tomogram,
+                    rec_filename,
                 ),
             ):
                 # Add the contribution to the average
@@ -304,19 +354,19 @@ def _average_particles_Config(
                 num[half_index] += 1
 
         # Average the sub tomograms
-        print("Averaging half 1 with %d particles" % num[0])
-        print("Averaging half 2 with %d particles" % num[1])
+        logger.info("Averaging half 1 with %d particles" % num[0])
+        logger.info("Averaging half 2 with %d particles" % num[1])
         if num[0] > 0:
             half[0, :, :, :] = half[0, :, :, :] / num[0]
         if num[1] > 0:
             half[1, :, :, :] = half[1, :, :, :] / num[1]
 
         # Save the averaged data
-        print("Saving half 1 to %s" % half_1_filename)
+        logger.info("Saving half 1 to %s" % half_1_filename)
         handle = mrcfile.new(half_1_filename, overwrite=True)
         handle.set_data(half[0, :, :, :])
         handle.voxel_size = tomo_file.voxel_size
-        print("Saving half 2 to %s" % half_2_filename)
+        logger.info("Saving half 2 to %s" % half_2_filename)
         handle = mrcfile.new(half_2_filename, overwrite=True)
         handle.set_data(half[1, :, :, :])
         handle.voxel_size = tomo_file.voxel_size
@@ -430,7 +480,7 @@ def _average_all_particles_Config(
             num_particles = len(positions)
         else:
             num_particles = min(num_particles, len(positions))
-        print(
+        logger.info(
             "Averaging %d %s particles with box size %d" % (num_particles, name, length)
         )
 
@@ -439,9 +489,11 @@ def _average_all_particles_Config(
         num = 0.0
 
         # Sort the positions and orientations by y
-        positions, orientations = zip(
-            *sorted(zip(positions, orientations), key=lambda x: x[0][1])
-        )
+        positions = np.asarray(positions)
+        orientations = np.asarray(orientations)
+        order = np.argsort(positions[:, 1], kind="stable")
+        positions = positions[order]
+        orientations = orientations[order]
 
         # Get the random indices
         indices = [list(range(len(positions)))]
@@ -460,16 +512,17 @@ def _average_all_particles_Config(
                     half_length,
                     average.shape,
                     voxel_size,
-                    tomogram,
+                    rec_filename,
                 ),
             ):
                 # Add the contribution to the average
                 average += data
                 num += 1
-                print("Count: ", num)
+                if num % 100 == 0:
+                    logger.info("Averaged %d particles" % num)
 
         # Average the sub tomograms
-        print("Averaging map with %d particles" % num)
+        logger.info("Averaging map with %d particles" % num)
         if num > 0:
             average = average / num
 
@@ -478,7 +531,7 @@ def _average_all_particles_Config(
         # pylab.show()
 
         # Save the averaged data
-        print("Saving map to %s" % average_filename)
+        logger.info("Saving map to %s" % average_filename)
         handle = mrcfile.new(average_filename, overwrite=True)
         handle.set_data(average)
         handle.voxel_size = tomo_file.voxel_size
@@ -9,14 +9,17 @@
 # which is included in the root directory of this package.
 #
 import concurrent.futures
+import logging
 import numpy as np
 import mrcfile
+import os
+import queue
 import random
+import threading
 import h5py
 import parakeet.sample
 from functools import singledispatch
 from math import sqrt, ceil
-from parakeet.analyse._average_particles import lazy_map
 from parakeet.analyse._average_particles import _process_sub_tomo
 from parakeet.analyse._average_particles import _iterate_particles
 
@@ -24,6 +27,10 @@ from parakeet.analyse._average_particles import _iterate_particles
 __all__ = ["extract", "average_extracted_particles"]
 
 
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
 # Set the random seed
 random.seed(0)
 
@@ -130,7 +137,7 @@ def _extract_Config(
         length = 2 * half_length
         assert len(positions) == len(orientations)
         num_particles = len(positions)
-        print(
+        logger.info(
             "Extracting %d %s particles with box size %d"
             % (num_particles, name, length)
         )
@@ -140,42 +147,106 @@ def _extract_Config(
         num = 0
 
         # Sort the positions and orientations by y
-        positions, orientations = zip(
-            *sorted(zip(positions, orientations), key=lambda x: x[0][1])
-        )
+        positions = np.asarray(positions)
+        orientations = np.asarray(orientations)
+        order = np.argsort(positions[:, 1], kind="stable")
+        positions = positions[order]
+        orientations = orientations[order]
 
         # Get the random indices
         indices = [list(range(len(positions)))]
 
-        # Create a file to store particles
-        handle = h5py.File(extract_file, "w")
-        handle["voxel_size"] = voxel_size
-        data_handle = handle.create_dataset(
-            "data", (0,) + shape, maxshape=(None,) + shape
+        # Enumerate the particle tasks up front - they only carry slice
+        # bounds - so the output dataset can be created at its final size
+        tasks = list(
+            _iterate_particles(
+                indices,
+                positions,
+                orientations,
+                centre,
+                size,
+                half_length,
+                shape,
+                voxel_size,
+                rec_filename,
+            )
         )
 
-        # Loop through all the particles
-        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-            for half_index, data in lazy_map(
-                executor,
-                _process_sub_tomo,
-                _iterate_particles(
-                    indices,
-                    positions,
-                    orientations,
-                    centre,
-                    size,
-                    half_length,
-                    shape,
-                    voxel_size,
-                    tomogram,
-                ),
-            ):
-                # Add the particle to the file
-                data_handle.resize(num + 1, axis=0)
-                data_handle[num, :, :, :] = data
+        # Create a file to store particles. The dataset is created at its
+        # final size since extensible datasets force a chunk B-tree layout
+        # that is pathologically slow for single-record writes. The chunks
+        # are sized at around 1 MB
+        # The raw chunk cache is sized to hold several chunks - the default
+        # 1 MB cache is smaller than one chunk for typical box sizes, which
+        # causes every write to evict and re-read its chunk. rdcc_w0=0
+        # biases eviction towards fully written chunks
+        chunk_n = max(1, min(len(tasks), 1048576 // (int(np.prod(shape)) * 4)))
+        chunk_bytes = chunk_n * int(np.prod(shape)) * 4
+        handle = h5py.File(
+            extract_file,
+            "w",
+            rdcc_nbytes=max(32 * 1024 * 1024, 4 * chunk_bytes),
+            rdcc_nslots=521 * 8,
+            rdcc_w0=0,
+        )
+        handle["voxel_size"] = voxel_size
+        if len(tasks) > 0:
+            data_handle = handle.create_dataset(
+                "data",
+                (len(tasks),) + shape,
+                dtype="float32",
+                chunks=(chunk_n,) + shape,
+                compression="lzf",
+                shuffle=True,
+            )
+        else:
+            data_handle = handle.create_dataset("data", (0,) + shape, dtype="float32")
+
+        # Loop through all the particles. Each result is written to its own
+        # slot as it completes rather than in submission order, so a slow
+        # particle doesn't hold up ones that have already finished. The
+        # number of in-flight futures is limited to twice the number of
+        # workers so that finished volumes cannot pile up in memory if the
+        # writer falls behind. The number of workers defaults to the number
+        # of cores and can be overridden through the environment
+        workers = int(os.environ.get("PARAKEET_EXTRACT_WORKERS", os.cpu_count() or 4))
+        max_pending = 2 * workers
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for index, task in enumerate(tasks):
+                futures[executor.submit(_process_sub_tomo, task)] = index
+                while len(futures) >= max_pending:
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        half_index, data = future.result()
+                        data_handle[futures.pop(future), :, :, :] = data
+                        num += 1
+                        if num % 100 == 0:
+                            logger.info("Extracted %d particles" % num)
+            for future in concurrent.futures.as_completed(list(futures)):
+                half_index, data = future.result()
+                data_handle[futures.pop(future), :, :, :] = data
                 num += 1
-                print("Count: ", num)
+                if num % 100 == 0:
+                    logger.info("Extracted %d particles" % num)
+
+
+def _contiguous_runs(indices):
+    """
+    Split the indices into [start, stop) runs of consecutive indices
+
+    Args:
+        indices: The particle indices
+
+    Returns:
+        The list of runs
+
+    """
+    indices = np.sort(np.asarray(indices))
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(indices, breaks)]
 
 
 def average_extracted_particles(
@@ -189,11 +260,18 @@ def average_extracted_particles(
 
     """
 
-    # Open the particles file
-    handle = h5py.File(particles_filename, "r")
+    # Open the particles file. The raw chunk cache is enlarged so that the
+    # blocked reads below don't thrash on chunks bigger than the 1 MB
+    # default cache
+    handle = h5py.File(
+        particles_filename,
+        "r",
+        rdcc_nbytes=128 * 1024 * 1024,
+        rdcc_nslots=521 * 8,
+    )
     data = handle["data"]
     voxel_size = tuple(handle["voxel_size"][:])
-    print("Voxel size: %s" % str(voxel_size))
+    logger.info("Voxel size: %s" % str(voxel_size))
 
     # Get the number of particles
     if num_particles is None or num_particles <= 0:
@@ -202,8 +280,10 @@ def average_extracted_particles(
     assert half_num_particles > 0
     assert num_particles <= data.shape[0]
 
-    # Setup the arrays
-    half = np.zeros((2,) + data.shape[1:], dtype="float32")
+    # Setup the arrays. The accumulation is done in double precision to
+    # avoid precision drift at large particle counts - the loop is memory
+    # bound so this costs nothing - and downcast once when saving
+    half = np.zeros((2,) + data.shape[1:], dtype="float64")
     num = np.zeros(2)
 
     # Get the random indices
@@ -212,31 +292,58 @@ def average_extracted_particles(
     )
     indices = [indices[:half_num_particles], indices[half_num_particles:]]
 
-    # Average the particles
-    print("Summing particles")
-    for half_index, particle_indices in enumerate(indices):
-        for i, particle_index in enumerate(particle_indices):
-            print(
-                "Half %d: adding %d / %d"
-                % (half_index + 1, i + 1, len(particle_indices))
-            )
-            half[half_index, :, :, :] += data[particle_index, :, :, :]
-            num[half_index] += 1
+    # Average the particles. The indices are sorted and split into runs of
+    # consecutive particles so that each HDF5 read covers a contiguous block
+    # instead of fetching one particle at a time. The blocks are read by a
+    # background thread so that the next read overlaps with the summation -
+    # h5py releases the GIL during the read so a small queue is sufficient
+    logger.info("Summing particles")
+    max_block_size = 16
+    blocks: queue.Queue = queue.Queue(maxsize=2)
+    read_error = []
+
+    def read_blocks():
+        # The sentinel is enqueued even if a read fails so that the consumer
+        # below never blocks forever. The exception is kept and re-raised in
+        # the main thread once the reader has been joined
+        try:
+            for half_index, particle_indices in enumerate(indices):
+                for start, stop in _contiguous_runs(particle_indices):
+                    for block_start in range(start, stop, max_block_size):
+                        block_stop = min(block_start + max_block_size, stop)
+                        blocks.put((half_index, data[block_start:block_stop]))
+        except Exception as e:
+            read_error.append(e)
+        finally:
+            blocks.put(None)
+
+    reader = threading.Thread(target=read_blocks, daemon=True)
+    reader.start()
+    while True:
+        item = blocks.get()
+        if item is None:
+            break
+        half_index, block = item
+        half[half_index, :, :, :] += block.sum(axis=0, dtype=np.float64)
+        num[half_index] += block.shape[0]
+    reader.join()
+    if read_error:
+        raise read_error[0]
 
     # Average the sub tomograms
-    print("Averaging half 1 with %d particles" % num[0])
-    print("Averaging half 2 with %d particles" % num[1])
+    logger.info("Averaging half 1 with %d particles" % num[0])
+    logger.info("Averaging half 2 with %d particles" % num[1])
     if num[0] > 0:
         half[0, :, :, :] = half[0, :, :, :] / num[0]
     if num[1] > 0:
         half[1, :, :, :] = half[1, :, :, :] / num[1]
 
     # Save the averaged data
-    print("Saving half 1 to %s" % half1_filename)
+    logger.info("Saving half 1 to %s" % half1_filename)
     handle = mrcfile.new(half1_filename, overwrite=True)
-    handle.set_data(half[0, :, :, :])
+    handle.set_data(half[0, :, :, :].astype(np.float32))
     handle.voxel_size = voxel_size
-    print("Saving half 2 to %s" % half2_filename)
+    logger.info("Saving half 2 to %s" % half2_filename)
     handle = mrcfile.new(half2_filename, overwrite=True)
-    handle.set_data(half[1, :, :, :])
+    handle.set_data(half[1, :, :, :].astype(np.float32))
     handle.voxel_size = voxel_size
@@ -83,10 +83,14 @@ def _reconstruct_Config(
     defocus = -microscope.lens.c_10
     num_defocus = int((nx * pixel_size) / 100)
 
-    # Set the spherical aberration
+    # Set the spherical aberration. The cc_corrected images already account
+    # for the CTF so the defocus sweep is skipped entirely by passing a
+    # single zero defocus to the reconstruction
     if simulation["inelastic_model"] == "cc_corrected":
         print("Setting spherical aberration to zero")
         spherical_aberration = 0.0
+        defocus = 0.0
+        num_defocus = 1
     else:
         spherical_aberration = microscope.lens.c_30
 
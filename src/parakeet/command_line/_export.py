@@ -327,33 +327,23 @@ def export_impl(args):
         args.output, shape=shape, pixel_size=pixel_size, dtype=dtype
     )
 
+    # Get the transform to apply to each image
+    transform = {
+        "complex": lambda x: x,
+        "real": lambda x: np.real(x),
+        "imaginary": lambda x: np.imag(x),
+        "amplitude": lambda x: np.abs(x),
+        "phase": lambda x: np.real(np.angle(x)),
+        "phase_unwrap": lambda x: np.unwrap(np.real(np.angle(x))),
+        "square": lambda x: np.abs(x) ** 2,
+        "imaginary_square": lambda x: np.imag(x) ** 2 + 1,
+    }[args.complex_mode]
+
     # If converting to images, determine min and max
     if writer.is_image_writer:
         if args.vmin is None or args.vmax is None:
             logger.info("Computing min and max of dataset:")
-            min_image = []
-            max_image = []
-            for i in indices:
-                # Transform if necessary
-                image = {
-                    "complex": lambda x: x,
-                    "real": lambda x: np.real(x),
-                    "imaginary": lambda x: np.imag(x),
-                    "amplitude": lambda x: np.abs(x),
-                    "phase": lambda x: np.real(np.angle(x)),
-                    "phase_unwrap": lambda x: np.unwrap(np.real(np.angle(x))),
-                    "square": lambda x: np.abs(x) ** 2,
-                    "imaginary_square": lambda x: np.imag(x) ** 2 + 1,
-                }[args.complex_mode](reader.data[i, y0:y1, x0:x1])
-
-                min_image.append(np.min(image))
-                max_image.append(np.max(image))
-                logger.info(
-                    "    Reading image %d: min/max: %.2f/%.2f"
-                    % (i, min_image[-1], max_image[-1])
-                )
-            writer.vmin = min(min_image)
-            writer.vmax = max(max_image)
+            writer.prepass(transform(reader.data[i, y0:y1, x0:x1]) for i in indices)
             logger.info("Min: %f" % writer.vmin)
             logger.info("Max: %f" % writer.vmax)
         if args.vmin:
@@ -377,16 +367,7 @@ def export_impl(args):
             header["stage_z"] = header["stage_z"]
 
         # Transform if necessary
-        image = {
-            "complex": lambda x: x,
-            "real": lambda x: np.real(x),
-            "imaginary": lambda x: np.imag(x),
-            "amplitude": lambda x: np.abs(x),
-            "phase": lambda x: np.real(np.angle(x)),
-            "phase_unwrap": lambda x: np.unwrap(np.real(np.angle(x))),
-            "square": lambda x: np.abs(x) ** 2,
-            "imaginary_square": lambda x: np.imag(x) ** 2 + 1,
-        }[args.complex_mode](image)
+        image = transform(image)
 
         # Filter the images
         if args.filter_shape is not None:
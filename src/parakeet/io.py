@@ -8,12 +8,16 @@
 # This code is distributed under the GPLv3 license, a copy of
 # which is included in the root directory of this package.
 #
+import builtins
+import collections
+import concurrent.futures
 import h5py
 import numpy as np
 import mrcfile
 import os
 import PIL.Image
 import parakeet
+from functools import cached_property
 
 # try:
 #     FEI_EXTENDED_HEADER_DTYPE = mrcfile.dtypes.FEI1_EXTENDED_HEADER_DTYPE
@@ -243,6 +247,75 @@ class Column(object):
         return self[:]
 
 
+class Position(object):
+    """
+    An object to represent the position columns
+
+    Assignments are dispatched to whole column slice writes on the
+    underlying fields rather than per element set calls
+
+    """
+
+    # The fields holding the position components
+    keys = ("shift_x", "shift_y", "stage_z")
+
+    def __init__(self, header):
+        self._header = header
+
+    @property
+    def shape(self):
+        """
+        The shape of the position array
+
+        """
+        return (self._header.size, 3)
+
+    def __getitem__(self, item):
+        """
+        Get the position elements
+
+        Args:
+            item: The array index
+
+        Returns:
+            The position elements
+
+        """
+        return np.asarray(self)[item]
+
+    def __setitem__(self, item, value):
+        """
+        Set the position elements
+
+        Args:
+            item: The array index
+            value: The position elements
+
+        """
+        if isinstance(item, tuple):
+            rows, cols = item
+        else:
+            rows, cols = item, slice(None)
+        cols = np.atleast_1d(np.arange(3)[cols])
+        if cols.size == 1:
+            self._header.set(rows, self.keys[cols[0]], value)
+        else:
+            value = np.asarray(value)
+            assert value.shape[-1] == cols.size
+            for index, col in enumerate(cols):
+                component = value[..., index]
+                if component.ndim == 0:
+                    component = component[()]
+                self._header.set(rows, self.keys[col], component)
+
+    def __array__(self, dtype=None):
+        """
+        Convert to a numpy array
+
+        """
+        return self._header._position_array()
+
+
 class Header(object):
     """
     An object to represent the header
@@ -312,11 +385,45 @@ class Header(object):
         """
         return self["tilt_alpha"]
 
+    @angle.setter
+    def angle(self, value):
+        """
+        Set all the angles with a single column assignment
+
+        """
+        self["tilt_alpha"] = value
+
     @property
-    def position(self) -> np.ndarray:
+    def position(self) -> "Position":
         """
         An alias to get the position
 
+        """
+        return Position(self)
+
+    @position.setter
+    def position(self, value):
+        """
+        Set all the positions with three column assignments
+
+        """
+        value = np.asarray(value)
+        assert value.shape == (self.size, 3)
+        self._set_position_array(value)
+
+    def _set_position_array(self, value):
+        """
+        Write the positions from an array
+
+        """
+        self["shift_x"] = value[:, 0]
+        self["shift_y"] = value[:, 1]
+        self["stage_z"] = value[:, 2]
+
+    def _position_array(self) -> np.ndarray:
+        """
+        Read the positions into an array
+
         """
         result = np.zeros(shape=(self.size, 3), dtype=np.float32)
         result[:, 0] = self["stage_x"][:] + self["shift_x"][:]
@@ -601,7 +708,9 @@ class MrcFileWriter(Writer):
         elif dtype == "complex128":
             dtype = np.dtype(np.complex64)
 
-        # Create the extended header
+        # Create the extended header. The records are written to the file
+        # verbatim so every field must start zeroed, and the single memset
+        # done by zeros is the cheapest way to achieve that
         extended_header = np.zeros(shape=shape[0], dtype=FEI_EXTENDED_HEADER_DTYPE)
         extended_header["Metadata size"] = extended_header.dtype.itemsize
 
@@ -677,6 +786,13 @@ class NexusHeader(Header):
         mapping = self.mapping(key)
         self._handle[mapping][index] = value
 
+        # Writing an individual position component invalidates the packed
+        # translation dataset until the full position array is set again
+        if key in ("stage_x", "stage_y", "stage_z", "shift_x", "shift_y"):
+            translation = self._handle.get("translation")
+            if translation is not None and translation.attrs.get("complete", False):
+                translation.attrs["complete"] = False
+
     @property
     def size(self):
         """
@@ -685,6 +801,49 @@ class NexusHeader(Header):
         """
         return self._handle["data"].shape[0]
 
+    def _position_array(self) -> np.ndarray:
+        """
+        Read the positions into an array
+
+        The packed (N, 3) translation dataset is preferred when it is up to
+        date since it takes a single read. Otherwise this does a single read
+        per component dataset directly into a preallocated buffer rather
+        than stacking and transposing temporaries
+
+        """
+        translation = self._handle.get("translation")
+        if translation is not None and translation.attrs.get("complete", False):
+            return translation[:]
+        result = np.zeros(shape=(self.size, 3), dtype=np.float32)
+        tmp = np.empty(shape=self.size, dtype=np.float32)
+        for index, keys in enumerate(
+            (("stage_x", "shift_x"), ("stage_y", "shift_y"), ("stage_z",))
+        ):
+            for key in keys:
+                self._handle[key].read_direct(tmp)
+                result[:, index] += tmp
+        return result
+
+    def _set_position_array(self, value):
+        """
+        Write the positions from an array
+
+        As well as the per-component datasets the positions are written in
+        one shot to the packed translation dataset, which is then marked as
+        complete so that readers can use the faster layout. The effective
+        position is stage + shift so the stage x/y offsets are folded into
+        the packed values to keep the two layouts consistent
+
+        """
+        super()._set_position_array(value)
+        translation = self._handle.get("translation")
+        if translation is not None:
+            packed = value.astype(np.float32, copy=True)
+            packed[:, 0] += self._handle["stage_x"][:]
+            packed[:, 1] += self._handle["stage_y"][:]
+            translation[:] = packed
+            translation.attrs["complete"] = True
+
 
 class ImageHeader(Header):
     """
@@ -758,10 +917,22 @@ class NexusWriter(Writer):
         instrument = entry.create_group("instrument")
         instrument.attrs["NX_class"] = "NXinstrument"
 
-        # Create the detector
+        # Create the detector. The data are chunked within image planes with
+        # each chunk around 1 MB. LZF is cheap enough not to bottleneck the
+        # writer and the shuffle filter improves the ratio on smooth images
+        chunk_rows = min(
+            shape[1], max(1, 1048576 // (shape[2] * np.dtype(dtype).itemsize))
+        )
         detector = instrument.create_group("detector")
         detector.attrs["NX_class"] = "NXdetector"
-        detector.create_dataset("data", shape=shape, dtype=dtype)
+        detector.create_dataset(
+            "data",
+            shape=shape,
+            dtype=dtype,
+            chunks=(1, chunk_rows, shape[2]),
+            compression="lzf",
+            shuffle=True,
+        )
         detector["image_key"] = np.zeros(shape=shape[0])
 
         # Create the sample
@@ -781,6 +952,15 @@ class NexusWriter(Writer):
         for key, (dtype, _) in self._header.dtype.fields.items():
             data.create_dataset(key, shape=shape[0], dtype=dtype)
 
+        # Create a packed (N, 3) dataset for the positions so that readers
+        # can fetch them with a single read instead of one per component
+        data.create_dataset(
+            "translation",
+            shape=(shape[0], 3),
+            dtype="float32",
+            chunks=(min(shape[0], 4096), 3),
+        )
+
         # Fill a few values
         self._header[:]["pixel_size_x"] = pixel_size
         self._header[:]["pixel_size_y"] = pixel_size
@@ -813,6 +993,59 @@ class ImageWriter(Writer):
             self.shape = shape
             self.vmin = vmin
             self.vmax = vmax
+            self._scratch = None
+            self._image = None
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+            self._pending: collections.deque = collections.deque()
+
+        @staticmethod
+        def _save_image(image, handle, format):
+            try:
+                PIL.Image.fromarray(image).save(handle, format=format)
+            finally:
+                handle.close()
+
+        def prepass(self, data):
+            """
+            Compute the scale limits from the full stack in a single pass
+
+            The stack can be an array or any iterable of frames, so callers
+            that transform or stream the frames can pass a generator and
+            the limits are accumulated one frame at a time. Only limits
+            that are not already set are filled in, so explicit values are
+            preserved. Calling this before the write loop means each frame
+            skips its own min/max reductions and the whole series is
+            quantized consistently
+
+            Args:
+                data (array): The full stack of images or frame iterable
+
+            """
+            if self.vmin is not None and self.vmax is not None:
+                return
+            vmin = None
+            vmax = None
+            for frame in data:
+                vmin = min(float(np.min(frame)), np.inf if vmin is None else vmin)
+                vmax = max(float(np.max(frame)), -np.inf if vmax is None else vmax)
+            if self.vmin is None:
+                self.vmin = vmin
+            if self.vmax is None:
+                self.vmax = vmax
+
+        def flush(self):
+            """
+            Wait until all submitted images have been written
+
+            """
+            while self._pending:
+                self._pending.popleft().result()
+
+        def __del__(self):
+            try:
+                self.flush()
+            except Exception:
+                pass
 
         def __setitem__(self, item, data):
             # Check the input
@@ -847,10 +1080,35 @@ class ImageWriter(Writer):
             s1 = 255.0 / (vmax - vmin)
             s0 = -s1 * vmin
 
-            # Save the image to file
+            # Quantize in place through preallocated scratch buffers rather
+            # than materializing a full precision temporary for each image
+            if self._scratch is None or self._scratch.shape != data.shape:
+                self._scratch = np.empty(shape=data.shape, dtype=np.float32)
+                self._image = np.empty(shape=data.shape, dtype=np.uint8)
+            np.multiply(data, s1, out=self._scratch, casting="unsafe")
+            np.add(self._scratch, s0, out=self._scratch)
+            np.clip(self._scratch, 0, 255, out=self._scratch)
+            np.rint(self._scratch, out=self._scratch)
+            image = self._image
+            image[...] = self._scratch
+
+            # Save the image to file. The file is created synchronously so
+            # that it exists when this call returns but the encode and write
+            # are handed to a background thread, overlapping the disk I/O
+            # with the quantization of the next frame. The image is copied
+            # because the scratch buffer is reused for the next frame
             filename = self.template % (item[0] + 1)
-            image = (data * s1 + s0).astype(np.uint8)
-            PIL.Image.fromarray(image).save(filename)
+            format = PIL.Image.registered_extensions()[
+                os.path.splitext(filename)[1].lower()
+            ]
+            handle = builtins.open(filename, "wb")
+            while self._pending and self._pending[0].done():
+                self._pending.popleft().result()
+            while len(self._pending) >= 4:
+                self._pending.popleft().result()
+            self._pending.append(
+                self._executor.submit(self._save_image, image.copy(), handle, format)
+            )
 
     def __init__(self, template, shape=None, vmin=None, vmax=None):
         """
@@ -900,6 +1158,20 @@ class ImageWriter(Writer):
         """
         self._data.vmax = vmax
 
+    def prepass(self, data):
+        """
+        Compute the scale limits for the full stack before writing
+
+        """
+        self._data.prepass(data)
+
+    def update(self):
+        """
+        Wait for any outstanding image writes before closing
+
+        """
+        self._data.flush()
+
 
 class Reader(object):
     """
@@ -933,6 +1205,22 @@ class Reader(object):
         self.shape = data.shape
         self.dtype = data.dtype
 
+    @cached_property
+    def angle(self) -> np.ndarray:
+        """
+        The tilt angles, parsed from the header on first access
+
+        """
+        return np.asarray(self.header.angle)
+
+    @cached_property
+    def position(self) -> np.ndarray:
+        """
+        The stage positions, parsed from the header on first access
+
+        """
+        return np.asarray(self.header.position)
+
     @property
     def start_angle(self):
         """
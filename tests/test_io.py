@@ -58,6 +58,10 @@ def test_read_write_mrcfile(tmp_path, io_test_data):
     assert np.all(np.equal(reader.header["tilt_alpha"], angle))
     assert np.all(np.equal(reader.header.position, position))
 
+    # Unset string fields in the extended header must round-trip as empty
+    # bytes rather than picking up stray values
+    assert np.all(reader.handle.indexed_extended_header["Microscope type"] == b"")
+
 
 def test_write_nexus(tmp_path, io_test_data):
     filename = os.path.join(tmp_path, "tmp.h5")
@@ -95,6 +99,28 @@ def test_write_nexus(tmp_path, io_test_data):
     assert np.all(np.equal(reader.header.position, position))
 
 
+def test_write_nexus_stage_then_position(tmp_path, io_test_data):
+    filename = os.path.join(tmp_path, "tmp.h5")
+
+    data, angle, position = io_test_data
+
+    writer = parakeet.io.new(filename, shape=data.shape)
+    for i in range(data.shape[0]):
+        writer.data[i, :, :] = data[i, :, :]
+        writer.header[i]["stage_x"] = 10
+        writer.header[i]["stage_y"] = 20
+
+    # Setting the whole position array must fold the stage offsets into
+    # the effective stage + shift position that is read back
+    writer.header.position = position
+
+    # Make sure stuff is written
+    writer = None
+
+    reader = parakeet.io.open(filename)
+    assert np.all(np.equal(reader.header.position, position + np.array([10, 20, 0])))
+
+
 def test_write_images(tmp_path, io_test_data):
     filename = os.path.join(tmp_path, "tmp_%03d.png")
 
@@ -127,6 +153,18 @@ def test_write_images(tmp_path, io_test_data):
     test(None, None)
     test(np.min(data), np.max(data))
 
+    # The prepass fills in unset limits from the whole stack
+    writer = parakeet.io.new(filename, shape=data.shape)
+    writer.prepass(data)
+    assert writer.vmin == np.min(data)
+    assert writer.vmax == np.max(data)
+
+    # Explicit limits are preserved
+    writer = parakeet.io.new(filename, shape=data.shape, vmin=1, vmax=2)
+    writer.prepass(data)
+    assert writer.vmin == 1
+    assert writer.vmax == 2
+
 
 def test_unknown_image(tmp_path):
     filename = os.path.join(tmp_path, "tmp.unknown")